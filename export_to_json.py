@@ -0,0 +1,17 @@
+import json
+import sys
+
+from primo import load_records
+
+def export_to_json(ledger_path, output_path):
+    """Convert a binary download ledger to an indented JSON list"""
+    records = load_records(ledger_path)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    print(f"Exported {len(records)} records to {output_path}")
+
+if __name__ == '__main__':
+    # Usage: python export_to_json.py [ledger] [output]
+    ledger_path = sys.argv[1] if len(sys.argv) > 1 else 'download_records.msgpack'
+    output_path = sys.argv[2] if len(sys.argv) > 2 else 'download_records.json'
+    export_to_json(ledger_path, output_path)
@@ -1,89 +1,128 @@
 import pandas as pd
-import json
 from pathlib import Path
 import fitz  # PyMuPDF
 import numpy as np
 from datetime import datetime
-from typing import Dict, List
-import hashlib
+from typing import Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import uuid
+import xxhash
 import PIL.Image
 import io
 
-class ImageExtractor:
-    def __init__(self, marc_json_path: str, output_dir: Path):
-        """
-        Initialize extractor with paths and configuration
-        """
-        self.df = pd.read_json(marc_json_path)
-        self.df["year"] = self.df["year"].replace("", 1800)
-        self.df["year"] = self.df["year"].replace("5780", 1780)
-        self.df.dropna(subset=["year"], inplace=True)
-        self.df["year"] = self.df["year"].astype(int)
-        self.df = self.df[self.df["pdf_filename"].str.contains("b")]
-        self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        self.image_metadata = []
-        
-    def generate_image_id(self, pdf_path: str, page_num: int, image_num: int) -> str:
-        """Generate unique ID for each image"""
-        unique_string = f"{pdf_path}_{page_num}_{image_num}"
-        return hashlib.md5(unique_string.encode()).hexdigest()[:12]
-        
-    def analyze_image(self, image_bytes: bytes) -> Dict:
-        """Analyze image properties using PIL"""
-        img = PIL.Image.open(io.BytesIO(image_bytes))
-        return {
-            'format': img.format,
-            'mode': img.mode,
-            'width': img.width,
-            'height': img.height,
-            'size_bytes': len(image_bytes)
-        }
-        
-    def select_pages(self, doc, total_pages: int) -> List[int]:
-        """Select pages to extract based on criteria"""
-        # Skip first and last 3 pages
-        start_page = 5
-        end_page = total_pages - 5
-        
-        # Calculate sampling rate based on book size
-        if total_pages < 50:
-            step = 5
-        elif total_pages < 100:
-            step = 8
-        else:
-            step = 10
-            
-        return list(range(start_page, end_page, step))
-        
-    def process_pdf(self, pdf_path: str, marc_record: Dict) -> List[Dict]:
-        """Extract images from PDF with metadata"""
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
-        selected_pages = self.select_pages(doc, total_pages)
-        page_metadata = []
+from json_utils import dump_json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+def generate_image_id(pdf_path: str, page_num: int, image_num: int) -> str:
+    """Generate unique ID for each image"""
+    unique_string = f"{pdf_path}_{page_num}_{image_num}"
+    return xxhash.xxh3_64_hexdigest(unique_string.encode())[:12]
+
+# Images narrower or shorter than this (in pixels) are not extracted
+MIN_IMAGE_SIZE = 64
+
+# PIL modes for the colorspace component counts MuPDF reports
+COLORSPACE_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+
+def image_mode(base_image: Dict) -> str:
+    """Get PIL image mode, opening the image only for unknown colorspaces"""
+    mode = COLORSPACE_MODES.get(base_image['colorspace'])
+    if mode is None:
+        with PIL.Image.open(io.BytesIO(base_image['image'])) as img:
+            mode = img.mode
+    return mode
+
+def select_pages(doc, total_pages: int) -> np.ndarray:
+    """Select pages to extract based on criteria"""
+    # Skip first and last 3 pages
+    start_page = 5
+    end_page = total_pages - 5
+    
+    # Calculate sampling rate based on book size
+    if total_pages < 50:
+        step = 5
+    elif total_pages < 100:
+        step = 8
+    else:
+        step = 10
         
-        for page_num in selected_pages:
+    return np.arange(start_page, end_page, step)
+
+def _write_bytes(path: Path, data: bytes):
+    """Write bytes to a content-addressed file with raw os calls
+
+    The bytes go to a temporary file in the same directory that is then
+    renamed, so the final name only ever holds a complete image. A file of
+    the right size already holds the same bytes (written by another worker
+    or a previous run) and is left alone; anything else is rewritten.
+    """
+    try:
+        if os.stat(path).st_size == len(data):
+            return
+    except FileNotFoundError:
+        pass
+    # A unique name per writer; mode 0o666 lets the umask apply, as open() does
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def process_pdf(pdf_path: str, marc_record: Dict, output_dir: Path) -> List[Dict]:
+    """Extract images from PDF with metadata"""
+    doc = fitz.open(pdf_path)
+    total_pages = len(doc)
+    selected_pages = select_pages(doc, total_pages)
+    relative_positions = selected_pages / total_pages
+    timestamp = datetime.now().isoformat()  # one extraction time per PDF
+    page_metadata = []
+    write_futures = []
+    written_hashes = set()
+    
+    # Write images in the background while MuPDF keeps extracting
+    with ThreadPoolExecutor(max_workers=4) as io_pool:
+        for page_num, relative_position in zip(selected_pages.tolist(), relative_positions.tolist()):
             page = doc[page_num]
             image_list = page.get_images()
             
             # Process each image on the page
             for img_idx, image in enumerate(image_list):
                 xref = image[0]  # Get the image reference
+                
+                # Skip thumbnails using the sizes get_images() already reports,
+                # before paying for stream decompression in extract_image()
+                width, height = image[2], image[3]
+                if width < MIN_IMAGE_SIZE or height < MIN_IMAGE_SIZE:
+                    continue
+                
                 base_image = doc.extract_image(xref)
                 
                 if base_image:  # Check if image extraction was successful
-                    # Generate unique ID and filename
-                    image_id = self.generate_image_id(pdf_path, page_num, img_idx)
-                    image_filename = f"{image_id}.{base_image['ext']}"
-                    image_path = self.output_dir / image_filename
-                    
-                    # Analyze image properties
-                    image_analysis = self.analyze_image(base_image["image"])
+                    # Generate unique ID, and name the file by its content so
+                    # images repeated across pages and books are stored once
+                    image_id = generate_image_id(pdf_path, page_num, img_idx)
+                    content_hash = xxhash.xxh3_128_hexdigest(base_image["image"])
+                    image_filename = f"{content_hash}.{base_image['ext']}"
+                    image_path = output_dir / image_filename
                     
                     # Save image
-                    with open(image_path, "wb") as f:
-                        f.write(base_image["image"])
+                    if content_hash not in written_hashes:
+                        written_hashes.add(content_hash)
+                        write_futures.append(io_pool.submit(_write_bytes, image_path, base_image["image"]))
                     
                     # Create metadata entry
                     metadata = {
@@ -97,23 +136,24 @@ class ImageExtractor:
                         'page_info': {
                             'page_number': page_num,
                             'total_pages': total_pages,
-                            'relative_position': page_num / total_pages,
+                            'relative_position': relative_position,
                             'images_on_page': len(image_list),
                             'image_index': img_idx
                         },
                         'image_properties': {
                             'path': str(image_path),
+                            'content_hash': content_hash,
                             'extension': base_image['ext'],
                             'colorspace': base_image['colorspace'],
-                            'width': image_analysis['width'],
-                            'height': image_analysis['height'],
-                            'size_bytes': image_analysis['size_bytes'],
-                            'mode': image_analysis['mode'],
+                            'width': base_image['width'],
+                            'height': base_image['height'],
+                            'size_bytes': len(base_image['image']),
+                            'mode': image_mode(base_image),
                             'original_dpi': base_image.get('xres', 0),
                             'compression': base_image.get('compression', ''),
                         },
                         'extraction_metadata': {
-                            'timestamp': datetime.now().isoformat(),
+                            'timestamp': timestamp,
                             'xref': xref,
                             'sampling_rate': f"1/{total_pages//len(selected_pages)}"
                         }
@@ -121,11 +161,45 @@ class ImageExtractor:
                     
                     page_metadata.append(metadata)
         
-        doc.close()
-        return page_metadata 
+    # Propagate any write errors
+    for future in write_futures:
+        future.result()
+    
+    doc.close()
+    return page_metadata 
+
+def _process_pdf_worker(args: Tuple[str, Dict, Path]) -> List[Dict]:
+    """Run process_pdf in a worker process, reporting errors instead of raising"""
+    pdf_path, marc_record, output_dir = args
+    try:
+        return process_pdf(pdf_path, marc_record, output_dir)
+    except Exception as e:
+        print(f"Error processing {pdf_path}: {str(e)}")
+        return []
 
+class ImageExtractor:
+    def __init__(self, marc_json_path: str, output_dir: Path):
+        """
+        Initialize extractor with paths and configuration
+        """
+        # Prefer the Parquet summary written alongside the JSON by MARCParser
+        marc_parquet_path = Path(marc_json_path).with_suffix('.parquet')
+        if marc_parquet_path.exists():
+            self.df = pd.read_parquet(marc_parquet_path, engine='pyarrow')
+        else:
+            self.df = pd.read_json(marc_json_path)
+        year = self.df["year"].replace({"": 1800, "5780": 1780})
+        self.df["year"] = pd.to_numeric(year, errors="coerce")
+        mask = self.df["year"].notna() & self.df["pdf_filename"].str.contains("b", na=False)
+        self.df = self.df.loc[mask].copy()
+        self.df["year"] = self.df["year"].astype(np.int32)
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.image_metadata = []
+        
     def process_all_books(self):
-        """Process all books from the DataFrame"""
+        """Process all books from the DataFrame in parallel worker processes"""
+        args = []
         for _, row in self.df.iterrows():
             marc_record = {
                 'marc_file': row['marc_file'],
@@ -134,11 +208,11 @@ class ImageExtractor:
             }
             
             pdf_path = f"books/{row['pdf_filename']}"
-            try:
-                page_metadata = self.process_pdf(pdf_path, marc_record)
+            args.append((pdf_path, marc_record, self.output_dir))
+        
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for page_metadata in executor.map(_process_pdf_worker, args, chunksize=4):
                 self.image_metadata.extend(page_metadata)
-            except Exception as e:
-                print(f"Error processing {pdf_path}: {str(e)}")
                 
         # Save complete metadata
         self.save_metadata()
@@ -159,8 +233,36 @@ class ImageExtractor:
             'images': self.image_metadata
         }
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata_package, f, indent=2, ensure_ascii=False)
+        dump_json(metadata_package, output_path)
+        
+        if pa is not None:
+            self.save_metadata_parquet(self.output_dir / 'images_metadata.parquet')
+            
+    def save_metadata_parquet(self, output_path: Path):
+        """Save a flat, columnar table of the image metadata to Parquet"""
+        columns = {
+            'image_id': [], 'pdf_file': [], 'control_number': [], 'year': [],
+            'page_number': [], 'relative_position': [], 'width': [], 'height': [],
+            'size_bytes': [], 'colorspace': [], 'path': [], 'content_hash': []
+        }
+        for img in self.image_metadata:
+            source = img['source']
+            page_info = img['page_info']
+            properties = img['image_properties']
+            columns['image_id'].append(img['image_id'])
+            columns['pdf_file'].append(source['pdf_file'])
+            columns['control_number'].append(source['control_number'])
+            columns['year'].append(int(source['year']))
+            columns['page_number'].append(page_info['page_number'])
+            columns['relative_position'].append(page_info['relative_position'])
+            columns['width'].append(properties['width'])
+            columns['height'].append(properties['height'])
+            columns['size_bytes'].append(properties['size_bytes'])
+            columns['colorspace'].append(properties['colorspace'])
+            columns['path'].append(properties['path'])
+            columns['content_hash'].append(properties['content_hash'])
+        
+        pq.write_table(pa.table(columns), output_path, compression='zstd')
             
     def get_year_distribution(self) -> Dict:
         """Calculate distribution of images across years"""
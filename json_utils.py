@@ -0,0 +1,30 @@
+import json
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Shared JSON writer for extractor.py and marc_parser.py
+
+def _json_default(obj):
+    """Serialize tuples (e.g. pymarc Subfield) as lists and NumPy values as
+    Python ones, like the stdlib json and orjson's numpy support do"""
+    if isinstance(obj, tuple):
+        return list(obj)
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def dumps_json(data) -> bytes:
+    """Serialize data as indented UTF-8 JSON, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.dumps(
+            data, default=_json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+    return json.dumps(data, default=_json_default, ensure_ascii=False, indent=2).encode('utf-8')
+
+def dump_json(data, output_path):
+    """Write data as indented JSON"""
+    Path(output_path).write_bytes(dumps_json(data))
@@ -1,12 +1,132 @@
 import re
-import json
+import os
+import mmap
 from pathlib import Path
-from typing import Dict, List, Optional, Set
-from dataclasses import dataclass, asdict, field
-from pymarc import MARCReader
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from dataclasses import dataclass, field
+from pymarc import Record, END_OF_RECORD
+from pymarc.exceptions import EndOfRecordNotFound, RecordLengthInvalid, TruncatedRecord
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-@dataclass
+from json_utils import dump_json, dumps_json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Patterns used on every record, compiled once
+_YEAR_RE = re.compile(r'\b(\d{4})\b')
+_PDF_VIEW_RE = re.compile(r'/([a-z]{2}\d+)/view(?:#.*)?$')
+_PDF_ID_RE = re.compile(r'/([a-z]{2}\d+)/')
+
+def iter_marc_records(file_path: str) -> Iterator[Record]:
+    """Yield records from an ISO 2709 file by slicing a memory-mapped buffer.
+
+    Each record starts with its 5-digit length, so records are cut out of the
+    buffer directly and only the slices are handed to pymarc.
+    """
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos = 0
+            end = len(buf)
+            while pos < end:
+                if end - pos < 5:
+                    raise TruncatedRecord()
+                try:
+                    length = int(buf[pos:pos + 5])
+                except ValueError:
+                    raise RecordLengthInvalid()
+                if length < 5 or pos + length > end:
+                    raise TruncatedRecord()
+                
+                chunk = buf[pos:pos + length]
+                if chunk[-1] != ord(END_OF_RECORD):
+                    raise EndOfRecordNotFound()
+                
+                yield Record(chunk, to_unicode=True, force_utf8=True)
+                pos += length
+
+# Define field names mapping
+FIELD_NAMES = {
+    "001": "Control Number",
+    "005": "Date and Time of Latest Transaction",
+    "100": "Main Entry - Personal Name",
+    "101": "Language Code",
+    "102": "Country of Publication",
+    "135": "Material Designation",
+    "140": "Coded Data Field",
+    "200": "Title Statement",
+    "210": "Publication, Distribution, etc.",
+    "215": "Physical Description",
+    "305": "Note - Data",
+    "310": "Note - Binding Information",
+    "314": "Note - Responsibility",
+    "316": "Note - Copy Information",
+    "317": "Provenance Note",
+    "321": "General Note",
+    "325": "General Note",
+    "399": "Local Note",
+    "454": "Translation Of",
+    "517": "Other Variant Titles",
+    "518": "Title in Standard Modern Spelling",
+    "620": "Subject Added Entry",
+    "700": "Added Entry - Personal Name",
+    "702": "Added Entry - Personal Name",
+    "712": "Added Entry - Corporate Name",
+    "801": "Source of Cataloging",
+    "852": "Location",
+    "856": "Electronic Location and Access",
+    "899": "Local Note",
+
+    # Adding previously unknown fields found in documentation
+    "105": "Field of Coded Data: Textual Resources, Monographic",
+    "205": "Edition Statement",
+    "300": "General Notes",
+    "303": "Note - Data", # Not found in documentation
+    "304": "Note - Bibliography",
+    "306": "Note - Data", # Not found in documentation  
+    "307": "Note - Data", # Not found in documentation
+    "327": "Notes About Contents",
+    "451": "Other Edition on Similar Medium",
+    "461": "Set Level",
+    "481": "Also Bound in This Volume",
+    "482": "Bound With",
+    "600": "Personal Name Used as Subject",
+    "606": "Topical Name Used as Subject",
+    "686": "Other Classification Numbers",
+    "701": "Personal Name - Alternative Responsibility",
+    "790": "Personal Name - Alternative Form",
+
+    "035": "Other System Numbers",
+    "320": "Bibliography / Index Note",
+    "330": "Summary or Abstract",
+    "412": "Source of Excerpt or Offprint",
+    "422": "Parent of Supplement",
+    "464": "Analytical Level",
+    "488": "Other Related Works",
+    "510": "Parallel Title",
+    "513": "Added Title-Page Title",
+    "514": "Caption Title",
+    "601": "Corporate Body Name Used as Subject",
+    "602": "Family Name Used as Subject",
+    "607": "Geographical Name Used as Subject",
+    "610": "Uncontrolled Subject Terms",
+    "710": "Corporate Body Name - Primary Responsibility",
+    "711": "Corporate Body Name - Alternative Responsibility",
+    "722": "Family Name - Secondary Responsibility",
+    "791": "Corporate Body Name - Alternative Form",
+    "830": "General Note",
+}
+
+# Control field tags (001-009) carry data instead of subfields
+_CONTROL_FIELDS = frozenset(f"{i:03d}" for i in range(10))
+
+@dataclass(slots=True)
 class MARCField:
     tag: str
     name: str
@@ -23,77 +143,7 @@ class MARCRecord:
     year: Optional[str] = None
 
 class MARCParser:
-    # Define field names mapping
-    FIELD_NAMES = {
-        "001": "Control Number",
-        "005": "Date and Time of Latest Transaction",
-        "100": "Main Entry - Personal Name",
-        "101": "Language Code",
-        "102": "Country of Publication",
-        "135": "Material Designation",
-        "140": "Coded Data Field",
-        "200": "Title Statement",
-        "210": "Publication, Distribution, etc.",
-        "215": "Physical Description",
-        "305": "Note - Data",
-        "310": "Note - Binding Information",
-        "314": "Note - Responsibility",
-        "316": "Note - Copy Information",
-        "317": "Provenance Note",
-        "321": "General Note",
-        "325": "General Note",
-        "399": "Local Note",
-        "454": "Translation Of",
-        "517": "Other Variant Titles",
-        "518": "Title in Standard Modern Spelling",
-        "620": "Subject Added Entry",
-        "700": "Added Entry - Personal Name",
-        "702": "Added Entry - Personal Name",
-        "712": "Added Entry - Corporate Name",
-        "801": "Source of Cataloging",
-        "852": "Location",
-        "856": "Electronic Location and Access",
-        "899": "Local Note",
-
-        # Adding previously unknown fields found in documentation
-        "105": "Field of Coded Data: Textual Resources, Monographic",
-        "205": "Edition Statement",
-        "300": "General Notes",
-        "303": "Note - Data", # Not found in documentation
-        "304": "Note - Bibliography",
-        "306": "Note - Data", # Not found in documentation  
-        "307": "Note - Data", # Not found in documentation
-        "327": "Notes About Contents",
-        "451": "Other Edition on Similar Medium",
-        "461": "Set Level",
-        "481": "Also Bound in This Volume",
-        "482": "Bound With",
-        "600": "Personal Name Used as Subject",
-        "606": "Topical Name Used as Subject",
-        "686": "Other Classification Numbers",
-        "701": "Personal Name - Alternative Responsibility",
-        "790": "Personal Name - Alternative Form",
-
-        "035": "Other System Numbers",
-        "320": "Bibliography / Index Note",
-        "330": "Summary or Abstract",
-        "412": "Source of Excerpt or Offprint",
-        "422": "Parent of Supplement",
-        "464": "Analytical Level",
-        "488": "Other Related Works",
-        "510": "Parallel Title",
-        "513": "Added Title-Page Title",
-        "514": "Caption Title",
-        "601": "Corporate Body Name Used as Subject",
-        "602": "Family Name Used as Subject",
-        "607": "Geographical Name Used as Subject",
-        "610": "Uncontrolled Subject Terms",
-        "710": "Corporate Body Name - Primary Responsibility",
-        "711": "Corporate Body Name - Alternative Responsibility",
-        "722": "Family Name - Secondary Responsibility",
-        "791": "Corporate Body Name - Alternative Form",
-        "830": "General Note",
-    }
+    FIELD_NAMES = FIELD_NAMES
 
     def __init__(self):
         self.unknown_fields = Counter()
@@ -110,12 +160,12 @@ class MARCParser:
         for url in urls:
             if "/view" in url:
                 # Updated pattern to handle URLs with parameters after 'view'
-                match = re.search(r'/([a-z]{2}\d+)/view(?:#.*)?$', url)
+                match = _PDF_VIEW_RE.search(url)
                 if match:
                     return f"{match.group(1)}.pdf"
             
                 # If first pattern doesn't match, try alternative pattern
-                match = re.search(r'/([a-z]{2}\d+)/', url)
+                match = _PDF_ID_RE.search(url)
                 if match:
                     return f"{match.group(1)}.pdf"
         print(f"Could not extract PDF filename from URLs: {urls}")
@@ -123,123 +173,160 @@ class MARCParser:
 
     def extract_year(self, value: str) -> Optional[str]:
         """Extract year from a string."""
-        match = re.search(r'\b(\d{4})\b', value)
-        return match.group(1) if match else None
+        return match.group(1) if (match := _YEAR_RE.search(value)) else None
 
     def parse_file(self, file_path: str, debug: bool = False) -> List[MARCRecord]:
         """Parse a single MARC file and return a list of records."""
         records = []
         marc_file = Path(file_path)
         
-        with open(file_path, 'rb') as file:
-            reader = MARCReader(file, to_unicode=True, force_utf8=True)
+        for record in iter_marc_records(file_path):
+           
+            control_number = record['001'].value() if '001' in record else 'Unknown ID'
             
-            for record in reader:
+            fields = []
+            urls = []  # Store URLs from 856 fields
+            year = ""
+            
+            # Process all fields in the record
+            for field in record:
                
-                control_number = record['001'].value() if '001' in record else 'Unknown ID'
+                # Skip empty fields
+                if not field:
+                    continue
+                
+                tag = field.tag
+                field_name = FIELD_NAMES.get(tag)
                 
-                fields = []
-                urls = []  # Store URLs from 856 fields
-                year = ""
+                # Handle control fields (001-009)
+                if tag in _CONTROL_FIELDS:
+                    if field_name is None:
+                        self.log_unknown_field(tag, field.data)
+                        field_name = "Unknown Field"
+                    fields.append(MARCField(
+                        tag=tag,
+                        name=field_name,
+                        value=field.data
+                    ))
+                    continue
                 
-                # Process all fields in the record
-                for field in record:
-                   
-                    # Skip empty fields
-                    if not field:
-                        continue
+                # Handle data fields (010 and above)
+                try:
+                    field_value = field.value()
                     
-                    # Check if field is unknown
-                    if field.tag not in self.FIELD_NAMES:
-                        self.log_unknown_field(field.tag, field.value())
+                    # Check if field is unknown, reusing the computed value
+                    if field_name is None:
+                        self.log_unknown_field(tag, field_value)
+                        field_name = "Unknown Field"
                     
-                    field_name = self.FIELD_NAMES.get(field.tag, "Unknown Field")
+                    # Store URLs from 856 fields
+                    if tag == '856':
+                        urls.append(field_value)
+                    elif tag == '210':
+                        year = self.extract_year(field_value)
                     
-                    # Handle control fields (001-009)
-                    if field.tag < '010':
-                        fields.append(MARCField(
-                            tag=field.tag,
-                            name=field_name,
-                            value=field.data
-                        ))
-                        continue
+                    # Data fields always carry a subfields list
+                    subfields = None
+                    if field.subfields:
+                        subfields = [
+                            {"code": code, "value": value}
+                            for code, value in zip(field.subfields[::2], field.subfields[1::2])
+                        ]
                     
-                    # Handle data fields (010 and above)
-                    try:
-                        field_value = field.value()
-                        
-                        # Store URLs from 856 fields
-                        if field.tag == '856':
-                            urls.append(field_value)
-                        if field.tag == '210':
-                            year = self.extract_year(field_value)
-                        
-                        subfields = None
-                        if hasattr(field, 'subfields') and field.subfields:
-                            subfields = [
-                                {"code": code, "value": value}
-                                for code, value in zip(field.subfields[::2], field.subfields[1::2])
-                            ]
-                        
-                        fields.append(MARCField(
-                            tag=field.tag,
-                            name=field_name,
-                            value=field_value,
-                            subfields=subfields
-                        ))
-                        
-                   
-                    except Exception as e:
-                        if debug:
-                            print(f"Error processing field {field.tag}: {str(e)}")
-                        continue
-                # Extract PDF filename from URLs
-                pdf_filename = self.extract_pdf_filename(urls)
+                    fields.append(MARCField(
+                        tag=tag,
+                        name=field_name,
+                        value=field_value,
+                        subfields=subfields
+                    ))
+                    
+               
+                except Exception as e:
+                    if debug:
+                        print(f"Error processing field {field.tag}: {str(e)}")
+                    continue
+            # Extract PDF filename from URLs
+            pdf_filename = self.extract_pdf_filename(urls)
 
-                records.append(MARCRecord(
-                    control_number=control_number,
-                    fields=fields,
-                    marc_file=marc_file.name,
-                    urls=urls,
-                    pdf_filename=pdf_filename,
-                    year=year
-                ))
-        
+            records.append(MARCRecord(
+                control_number=control_number,
+                fields=fields,
+                marc_file=marc_file.name,
+                urls=urls,
+                pdf_filename=pdf_filename,
+                year=year
+            ))
+    
         return records
 
     def process_directory(self, directory_path: str, output_path: str, debug: bool = False):
-        """Process all MARC files in a directory and save as JSON."""
+        """Process all MARC files in a directory and stream them to a JSON array.
+
+        When pyarrow is available, the record summaries (everything except
+        the fields) are also saved as Parquet next to the JSON output.
+        """
         dir_path = Path(directory_path)
-        all_records = []
+        record_count = 0
+        summaries = []
         
-        for marc_file in dir_path.glob("*.mrc"):
+        with open(output_path, 'wb') as f:
+            f.write(b'[')
             
-            try:
-                records = self.parse_file(str(marc_file), debug=debug)
-                all_records.extend(records)
+            # Parse files in worker processes; map() keeps the glob order
+            marc_files = [str(marc_file) for marc_file in dir_path.glob("*.mrc")]
+            with ProcessPoolExecutor() as executor:
+                results = executor.map(_parse_file_worker, marc_files, [debug] * len(marc_files))
                 
-           
-            except Exception as e:
-                print(f"Error processing {marc_file}: {str(e)}")
-        
-        # Convert to JSON-serializable format
-        json_records = [
-            {
-                "control_number": record.control_number,
-                "fields": [asdict(field) for field in record.fields],
-                "marc_file": record.marc_file,
-                "urls": record.urls,
-                "pdf_filename": record.pdf_filename,
-                "year": record.year
-            }
-            for record in all_records
-        ]
+                for records, unknown_fields, unknown_field_examples in results:
+                    self.unknown_fields.update(unknown_fields)
+                    for tag, example in unknown_field_examples.items():
+                        self.unknown_field_examples.setdefault(tag, example)
+                    
+                    # Write each record as an array element, nested one level deep
+                    for record in records:
+                        f.write(b',\n  ' if record_count else b'\n  ')
+                        f.write(dumps_json(self.record_to_dict(record)).replace(b'\n', b'\n  '))
+                        record_count += 1
+                        
+                        summaries.append({
+                            "control_number": record.control_number,
+                            "marc_file": record.marc_file,
+                            "urls": record.urls,
+                            "pdf_filename": record.pdf_filename,
+                            "year": record.year
+                        })
+            
+            f.write(b'\n]' if record_count else b']')
         
-        # Save to JSON file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(json_records, f, ensure_ascii=False, indent=2)
+        if pa is not None:
+            self.save_summaries_parquet(summaries, Path(output_path).with_suffix('.parquet'))
         
-        return len(all_records)
+        return record_count
+
+    def save_summaries_parquet(self, summaries: List[Dict], output_path: Path):
+        """Save record summaries as a zstd-compressed Parquet file."""
+        table = pa.Table.from_pylist(summaries, schema=pa.schema([
+            ("control_number", pa.string()),
+            ("marc_file", pa.string()),
+            ("urls", pa.list_(pa.string())),
+            ("pdf_filename", pa.string()),
+            ("year", pa.string()),
+        ]))
+        pq.write_table(table, output_path, compression='zstd')
+
+    def record_to_dict(self, record: MARCRecord) -> Dict:
+        """Convert a record to a JSON-serializable dict."""
+        return {
+            "control_number": record.control_number,
+            "fields": [
+                {"tag": f.tag, "name": f.name, "value": f.value, "subfields": f.subfields}
+                for f in record.fields
+            ],
+            "marc_file": record.marc_file,
+            "urls": record.urls,
+            "pdf_filename": record.pdf_filename,
+            "year": record.year
+        }
 
     def save_unknown_fields_report(self, output_path: str):
         """Save a report of unknown fields encountered during parsing."""
@@ -258,8 +345,21 @@ class MARCParser:
             ]
         }
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(report, f, ensure_ascii=False, indent=2)
+        dump_json(report, output_path)
+
+def _parse_file_worker(file_path: str, debug: bool = False) -> Tuple[List[MARCRecord], Counter, Dict[str, str]]:
+    """Parse one MARC file in a worker process.
+
+    Returns the records together with the worker's unknown-field counts and
+    examples so the parent parser can merge them.
+    """
+    parser = MARCParser()
+    try:
+        records = parser.parse_file(file_path, debug=debug)
+    except Exception as e:
+        print(f"Error processing {file_path}: {str(e)}")
+        records = []
+    return records, parser.unknown_fields, parser.unknown_field_examples
 
 def main():
     # Example usage
@@ -7,6 +7,8 @@ from pathlib import Path
 from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 from typing import List, Dict, Optional
 
+from primo import block_heavy_resources, save_download
+
 # Set up logging
 logging.basicConfig(
     filename=f'scraper_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log',
@@ -15,13 +17,14 @@ logging.basicConfig(
 )
 
 class MARCDownloader:
-    def __init__(self, records: List[Dict], output_dir: str = "marc"):
+    def __init__(self, records: List[Dict], output_dir: str = "marc", concurrency: int = 4):
         self.records = records
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
+        self.concurrency = concurrency
         self.browser = None
-        self.context = None
-        self.page = None
+        self.contexts = []
+        self.context_queue = None
     
     def extract_nlr_id(self, url: str) -> Optional[str]:
         """Extract NLR identifier from URL."""
@@ -45,22 +48,25 @@ class MARCDownloader:
         return exists
         
     async def setup(self):
-        """Initialize browser and context"""
+        """Initialize browser and a pool of independent contexts"""
         try:
             self.playwright = await async_playwright().start()
             self.browser = await self.playwright.chromium.launch(
                 headless=False,
                 args=['--disable-dev-shm-usage']  # Helps with memory issues
             )
-            self.context = await self.browser.new_context(
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                viewport={'width': 1920, 'height': 1080}
-            )
-            self.page = await self.context.new_page()
             
-            # Set default timeouts
-            self.page.set_default_timeout(10000)
-            self.page.set_default_navigation_timeout(10000)
+            # Each worker checks a context out of the queue, so at most
+            # `concurrency` downloads run at once
+            self.context_queue = asyncio.Queue()
+            for _ in range(self.concurrency):
+                context = await self.browser.new_context(
+                    user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                    viewport={'width': 1920, 'height': 1080}
+                )
+                await context.route("**/*", block_heavy_resources)
+                self.contexts.append(context)
+                self.context_queue.put_nowait(context)
             
         except Exception as e:
             logging.error(f"Setup failed: {str(e)}")
@@ -70,10 +76,8 @@ class MARCDownloader:
     async def cleanup(self):
         """Clean up resources"""
         try:
-            if self.page:
-                await self.page.close()
-            if self.context:
-                await self.context.close()
+            for context in self.contexts:
+                await context.close()
             if self.browser:
                 await self.browser.close()
             if hasattr(self, 'playwright'):
@@ -81,8 +85,8 @@ class MARCDownloader:
         except Exception as e:
             logging.error(f"Cleanup error: {str(e)}")
 
-    async def download_marc_file(self, record: Dict) -> bool:
-        """Download a single MARC file"""
+    async def download_marc_file(self, record: Dict, page) -> bool:
+        """Download a single MARC file using the given page"""
         try:
             link = record['rusmarc_url']
             
@@ -93,23 +97,24 @@ class MARCDownloader:
             logging.info(f"Processing URL: {link}")
             
             # Navigate to page
-            await self.page.goto(link)
-            await self.page.wait_for_load_state('networkidle')
+            await page.goto(link)
             
-            # Look for download link
-            rusmarc_link = self.page.locator('text=RUSMARC ISO2709')
-            if await rusmarc_link.count() == 0:
+            # Wait only for the download link rather than for network idle
+            rusmarc_link = page.locator('text=RUSMARC ISO2709')
+            try:
+                await rusmarc_link.first.wait_for(state='visible', timeout=15000)
+            except PlaywrightTimeoutError:
                 logging.warning(f"No RUSMARC download link found for {link}")
                 return False
             
             # Download file
-            async with self.page.expect_download(timeout=2000) as download_info:
-                await rusmarc_link.click()
+            async with page.expect_download(timeout=2000) as download_info:
+                await rusmarc_link.first.click()
                 
             download = await download_info.value
             output_path = self.output_dir / download.suggested_filename
             
-            await download.save_as(output_path)
+            await save_download(download, output_path)
             logging.info(f"Successfully downloaded: {output_path}")
             
             # Verify file exists and has content
@@ -126,15 +131,17 @@ class MARCDownloader:
             logging.error(f"Error downloading MARC file: {str(e)}")
             return False
 
-    async def process_all_records(self):
-        """Process all records with retry logic"""
-        retry_count = 1
-        retry_delay = 1
-        
+    async def process_record(self, record: Dict, retry_count: int = 1, retry_delay: int = 1):
+        """Download one record's MARC file on a pooled context, with retry logic"""
+        context = await self.context_queue.get()
         try:
-            await self.setup()
+            page = await context.new_page()
             
-            for record in self.records:
+            # Set default timeouts
+            page.set_default_timeout(10000)
+            page.set_default_navigation_timeout(10000)
+            
+            try:
                 success = False
                 
                 for attempt in range(retry_count):
@@ -142,12 +149,22 @@ class MARCDownloader:
                         logging.info(f"Retry attempt {attempt + 1} for {record['rusmarc_url']}")
                         await asyncio.sleep(retry_delay * attempt)
                     
-                    success = await self.download_marc_file(record)
+                    success = await self.download_marc_file(record, page)
                     if success:
                         break
                 
                 if not success:
                     logging.error(f"Failed to download after {retry_count} attempts: {record['rusmarc_url']}")
+            finally:
+                await page.close()
+        finally:
+            self.context_queue.put_nowait(context)
+
+    async def process_all_records(self):
+        """Process all records concurrently across the context pool"""
+        try:
+            await self.setup()
+            await asyncio.gather(*(self.process_record(record) for record in self.records))
                 
         except Exception as e:
             logging.error(f"Process failed: {str(e)}")
@@ -0,0 +1,534 @@
+import asyncio
+import contextlib
+import html
+import json
+import logging
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from email.message import Message
+from http.cookies import SimpleCookie
+from typing import Dict, Optional, Set
+from urllib.parse import urljoin
+
+import aiofiles
+import aiofiles.os
+import aiohttp
+import msgpack
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from yarl import URL
+
+# Shared item logic for the NLR Primo scrapers (scrape.py and scraper.py)
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# "Электронная копия" buttons on a search results page, one per item
+BUTTON_SELECTOR = 'button.neutralized-button:has-text("Электронная копия")'
+
+# Search result ids of all buttons on a page, in page order, read once
+# before any button is clicked
+RECORD_IDS_JS = "bs => bs.map(b => b.closest('[id]')?.id)"
+
+# Export link on the full bibliographic description page
+RUSMARC_LINK_RE = re.compile(r'<a\b[^>]*\bhref="([^"]+)"[^>]*>\s*RUSMARC ISO2709', re.IGNORECASE)
+
+# Cookies and local storage persisted between runs
+STORAGE_STATE_PATH = 'state.json'
+
+# Resource types the scraper never needs; stylesheets are kept so that
+# visibility-based waits still reflect the real layout
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+
+# Analytics and tracking hosts whose beacons keep the network busy
+BLOCKED_HOSTS = ("google-analytics.com", "googletagmanager.com", "mc.yandex.ru", "top-fwz1.mail.ru")
+
+async def block_heavy_resources(route):
+    """Abort requests for resources and trackers that are never used"""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(host in request.url for host in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def save_download(download, filename, sync=False):
+    """Move a finished download into place off the event loop.
+
+    Playwright's own copy of the file is renamed when it lives on the same
+    filesystem; otherwise it is copied to a temporary path and moved. With
+    `sync`, the file's data is fsynced before the rename.
+    """
+    src = await download.path()
+    if os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(filename))).st_dev:
+        if sync:
+            await asyncio.to_thread(fsync_path, src)
+        await asyncio.to_thread(os.replace, src, filename)
+        return
+
+    tmp_path = temp_path_for(filename)
+    try:
+        await download.save_as(tmp_path)
+        if sync:
+            await asyncio.to_thread(fsync_path, tmp_path)
+        await asyncio.to_thread(os.replace, tmp_path, filename)
+    except BaseException:
+        # Cancellation can arrive after the threaded replace already ran
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+def fsync_path(path):
+    """fsync a file or directory by path"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def temp_path_for(filename):
+    """Create a unique temporary file next to `filename` and return its path.
+
+    Concurrent writers of the same file never share a temporary path. The
+    file is created with mode 0o666 so the umask applies, as open() does.
+    """
+    tmp_path = f"{os.path.abspath(filename)}.{uuid.uuid4().hex}.part"
+    os.close(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    return tmp_path
+
+def attachment_filename(content_disposition):
+    """File name from a Content-Disposition header, or None"""
+    if not content_disposition:
+        return None
+    message = Message()
+    message['content-disposition'] = content_disposition
+    filename = message.get_filename()
+    return os.path.basename(filename) if filename else None
+
+class DirectorySync:
+    """fsyncs a directory once every `every` files moved into it.
+
+    This makes the renames durable in batches rather than with a sync per
+    file. It doesn't persist file contents: RUSMARC records are fsynced
+    before they are renamed, while main files are not and may come back
+    empty or truncated after a crash.
+    """
+
+    def __init__(self, path='.', every=10):
+        self.path = path
+        self.every = every
+        self.pending = 0
+
+    async def completed(self):
+        self.pending += 1
+        if self.pending >= self.every:
+            await asyncio.to_thread(self.sync)
+
+    def sync(self):
+        self.pending = 0
+        fsync_path(self.path)
+
+# First bytes of every ledger file, so that other files are never mistaken
+# for one (and truncated)
+LEDGER_MAGIC = b'NLRLEDG\x01'
+
+class RecordLedger:
+    """Buffered ledger writer that flushes every `flush_every` records.
+
+    After the LEDGER_MAGIC header, each record is a MessagePack map preceded
+    by its length as a 4-byte big-endian integer; export_to_json.py converts
+    a ledger to JSON.
+    """
+
+    def __init__(self, path, flush_every=10):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > len(LEDGER_MAGIC) or (size and not LEDGER_MAGIC.startswith(_read_head(path))):
+            # Drop a record cut short by an interrupted run so that new
+            # records stay aligned to their length prefixes
+            with open(path, 'rb') as f:
+                _, end = _read_frames(f.read(), path)
+            if end < size:
+                logging.warning(f"Dropping {size - end} bytes of an incomplete record at the end of {path}")
+                os.truncate(path, end)
+            self.file = open(path, 'ab')
+        else:
+            # New, empty or cut short before the header was complete
+            self.file = open(path, 'wb')
+            self.file.write(LEDGER_MAGIC)
+            self.file.flush()
+        self.flush_every = flush_every
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    async def append(self, record):
+        """Append a record without blocking the event loop"""
+        await asyncio.to_thread(self._write, _frame(record))
+
+    def _write(self, frame):
+        with self.lock:
+            self.file.write(frame)
+            self.pending += 1
+            if self.pending >= self.flush_every:
+                self.file.flush()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def load_records(path):
+    """Read all records from a ledger written by RecordLedger.
+
+    A record cut short by an interrupted run is ignored.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if len(buf) <= len(LEDGER_MAGIC) and LEDGER_MAGIC.startswith(buf):
+        return []
+    records, _ = _read_frames(buf, path)
+    return records
+
+def _frame(record):
+    data = msgpack.packb(record, use_bin_type=True)
+    return struct.pack('>I', len(data)) + data
+
+def _read_head(path):
+    with open(path, 'rb') as f:
+        return f.read(len(LEDGER_MAGIC))
+
+def _read_frames(buf, path):
+    """Decode complete records after the header; returns them and their end.
+
+    Only a frame running past the end of `buf` counts as cut short; a file
+    without the header or with an undecodable record raises ValueError.
+    """
+    if not buf.startswith(LEDGER_MAGIC):
+        raise ValueError(f"{path} is not a download ledger")
+    records = []
+    pos = len(LEDGER_MAGIC)
+    while pos + 4 <= len(buf):
+        (length,) = struct.unpack_from('>I', buf, pos)
+        end = pos + 4 + length
+        if end > len(buf):
+            break
+        try:
+            records.append(msgpack.unpackb(buf[pos + 4:end], raw=False))
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ValueError(f"Corrupt record at byte {pos} of {path}: {e}") from e
+        pos = end
+    return records, pos
+
+def import_legacy_records(path, legacy_paths):
+    """Seed a new ledger with the records of ledgers from earlier versions.
+
+    Does nothing once `path` exists, so the import happens on the first run
+    only. The ledger is written to a temporary file and moved into place.
+    """
+    if os.path.exists(path):
+        return
+    records = []
+    for legacy_path in legacy_paths:
+        if os.path.exists(legacy_path):
+            records.extend(_load_legacy_records(legacy_path))
+    if not records:
+        return
+
+    tmp_path = f"{path}.part"
+    with open(tmp_path, 'wb') as f:
+        f.write(LEDGER_MAGIC)
+        for record in records:
+            f.write(_frame(record))
+    os.replace(tmp_path, path)
+    logging.info(f"Imported {len(records)} records from {', '.join(legacy_paths)} into {path}")
+
+def _load_legacy_records(path):
+    """Read item records from an indented JSON list or a JSON-Lines ledger.
+
+    Offset listings that JSON-Lines ledgers also held are left out.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = json.load(f)
+    return [record for record in records if "offset" not in record]
+
+def record_keys(record):
+    """Keys identifying a downloaded item: its result id and RUSMARC URL"""
+    return {key for key in (record.get("record_id"), record.get("rusmarc_url")) if key}
+
+class RateLimitCooldown:
+    """Pauses new items for a while after the server answers 429"""
+
+    def __init__(self, seconds=30):
+        self.seconds = seconds
+        self.until = 0.0
+
+    def on_response(self, response):
+        if response.status == 429:
+            logging.warning(f"Rate limited by {response.url}, pausing for {self.seconds} seconds")
+            self.until = time.monotonic() + self.seconds
+
+    async def wait(self):
+        delay = self.until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+@dataclass
+class FetchOpts:
+    """What fetch_one does for each item besides downloading the main file"""
+    fetch_rusmarc: bool = False  # also download the RUSMARC ISO2709 record
+    ledger: Optional[RecordLedger] = None  # append a record per download
+    seen: Set[str] = field(default_factory=set)  # record keys to skip
+    cooldown: RateLimitCooldown = field(default_factory=RateLimitCooldown)
+    retry_count: int = 3  # attempts per item on timeouts
+    session: Optional[aiohttp.ClientSession] = None  # plain HTTP client for resolved URLs
+    dir_sync: DirectorySync = field(default_factory=DirectorySync)
+
+async def new_context(browser, opts: FetchOpts):
+    """Create a browser context with resource blocking and 429 detection.
+
+    Cookies from an earlier run are restored so the session starts warm.
+    """
+    context = await browser.new_context(
+        user_agent=USER_AGENT,
+        storage_state=STORAGE_STATE_PATH if os.path.exists(STORAGE_STATE_PATH) else None
+    )
+    # Route on the context so popups opened from its pages are covered too
+    await context.route("**/*", block_heavy_resources)
+    context.on("response", opts.cooldown.on_response)
+    return context
+
+async def open_http_session(context):
+    """Create an aiohttp session carrying the browser context's cookies.
+
+    Call it after the first navigation so the session cookies exist.
+    """
+    jar = aiohttp.CookieJar()
+    for cookie in await context.cookies():
+        morsel = SimpleCookie()
+        morsel[cookie['name']] = cookie['value']
+        morsel[cookie['name']]['domain'] = cookie['domain']
+        morsel[cookie['name']]['path'] = cookie['path']
+        jar.update_cookies(morsel, URL(f"https://{cookie['domain'].lstrip('.')}/"))
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=10, limit_per_host=5),
+        cookie_jar=jar,
+        headers={'User-Agent': USER_AGENT}
+    )
+
+async def list_item_buttons(page):
+    """Wait for a results page's item buttons; returns their locator and ids.
+
+    Buttons are resolved lazily by index, so a re-rendered list can't leave
+    callers holding stale handles. A page without any buttons (none of its
+    items has a digital copy) gives an empty id list rather than an error.
+    """
+    buttons = page.locator(BUTTON_SELECTOR)
+    try:
+        await buttons.first.wait_for()
+    except PlaywrightTimeoutError:
+        logging.warning(f"No \"Электронная копия\" buttons found on {page.url}")
+        return buttons, []
+
+    record_ids = await buttons.evaluate_all(RECORD_IDS_JS)
+    counts = Counter(record_ids)
+    shared = [record_id for record_id, count in counts.items() if record_id and count > 1]
+    if shared:
+        logging.warning(f"Ignoring result ids shared by several buttons on {page.url}: {', '.join(shared)}")
+    return buttons, [record_id if counts[record_id] == 1 else None for record_id in record_ids]
+
+async def fetch_one(page, button, index, record_id, opts: FetchOpts, popup_lock=None) -> Optional[Dict]:
+    """Open one search result and download its files.
+
+    `record_id` is the item's search result id from RECORD_IDS_JS, or None.
+    Items already in `opts.seen` are skipped, and timeouts are retried with
+    exponential backoff. `popup_lock` serializes clicks on a results page
+    shared by concurrent tasks, so each task receives the popup it opened.
+    Returns the download record, or None if nothing was downloaded.
+    """
+    # Skip items downloaded by an earlier run before opening anything
+    if record_id and record_id in opts.seen:
+        logging.info(f"Skipping item {index}: {record_id} already downloaded")
+        return None
+
+    # RUSMARC fetches started for this item; they outlive the attempt that
+    # started them and are awaited before returning
+    rusmarc_tasks = []
+    try:
+        return await _fetch_with_retries(page, button, index, record_id, opts, popup_lock, rusmarc_tasks)
+    finally:
+        await asyncio.gather(*rusmarc_tasks, return_exceptions=True)
+
+async def _fetch_with_retries(page, button, index, record_id, opts: FetchOpts, popup_lock, rusmarc_tasks) -> Optional[Dict]:
+    for attempt in range(opts.retry_count):
+        await opts.cooldown.wait()
+        try:
+            return await _fetch_item(page, button, index, record_id, opts, popup_lock, rusmarc_tasks)
+
+        except PlaywrightTimeoutError:
+            if attempt < opts.retry_count - 1:
+                # Exponential backoff with jitter before retrying just this item
+                delay = 2 ** attempt + random.random()
+                logging.warning(f"Timeout processing item {index}, retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+            else:
+                logging.error(f"Timeout error processing item {index}")
+        except Exception as e:
+            logging.error(f"Unexpected error processing item {index}: {str(e)}")
+            return None
+
+    return None
+
+async def _fetch_item(page, button, index, record_id, opts: FetchOpts, popup_lock, rusmarc_tasks) -> Optional[Dict]:
+    logging.info(f"Processing item {index}")
+
+    async with popup_lock or contextlib.nullcontext():
+        async with page.expect_popup() as popup_info:
+            await button.click()
+        new_page = await popup_info.value
+
+    try:
+        return await _process_item_page(new_page, index, record_id, opts, rusmarc_tasks)
+    finally:
+        await new_page.close()
+
+async def _process_item_page(new_page, index, record_id, opts: FetchOpts, rusmarc_tasks) -> Optional[Dict]:
+    """Download an item's files from its opened page"""
+    # Click on "Карточка" tab
+    await new_page.click('text="Карточка"')
+
+    # Get bibliographic description
+    bibl_link = new_page.locator('text=Полное библиографическое описание')
+    await bibl_link.wait_for()
+    rusmarc_url = await bibl_link.get_attribute('href')
+
+    # Ledger entries without a record id can still be matched by URL
+    if rusmarc_url in opts.seen:
+        logging.info(f"Skipping item {index}: {rusmarc_url} already downloaded")
+        return None
+
+    # The RUSMARC record is fetched over HTTP while the main file downloads
+    # through the item page. The fetch keeps going if the main file fails,
+    # so the record is kept either way, and a retry starts another fetch
+    # only if the previous one failed
+    if opts.fetch_rusmarc and _rusmarc_needed(rusmarc_tasks):
+        rusmarc_tasks.append(asyncio.create_task(
+            _download_rusmarc(new_page.context, urljoin(new_page.url, rusmarc_url), index, opts)
+        ))
+    filename = await _download_main_file(new_page, index)
+    await opts.dir_sync.completed()
+    if rusmarc_tasks:
+        await rusmarc_tasks[-1]
+
+    # Save record to the ledger and mark it as seen
+    record = {
+        "record_id": record_id,
+        "rusmarc_url": rusmarc_url,
+        "downloaded_file": filename,
+    }
+    opts.seen.update(record_keys(record))
+    if opts.ledger is not None:
+        await opts.ledger.append(record)
+
+    await new_page.wait_for_selector('text="Закрыть"')
+    await new_page.click('text="Закрыть"')
+    return record
+
+def _rusmarc_needed(rusmarc_tasks) -> bool:
+    """Whether no RUSMARC fetch for the item is running or has succeeded"""
+    if not rusmarc_tasks:
+        return True
+    task = rusmarc_tasks[-1]
+    return task.done() and (task.cancelled() or not task.result())
+
+async def _download_rusmarc(context, rusmarc_url, index, opts: FetchOpts) -> bool:
+    """Download the RUSMARC record from the bibliographic description page.
+
+    Returns whether the record was saved. The page and the export are
+    fetched with the plain HTTP session; the page is only rendered in the
+    browser when that fails or the export link isn't present in its HTML,
+    and not before any 429 cooldown has passed.
+    """
+    if opts.session is not None:
+        try:
+            if await _fetch_rusmarc_http(opts.session, rusmarc_url, opts.cooldown):
+                await opts.dir_sync.completed()
+                logging.info(f"Successfully downloaded RUSMARC file for item {index}")
+                return True
+        except Exception as e:
+            logging.warning(f"HTTP fetch of RUSMARC for item {index} failed, rendering the page: {str(e)}")
+        await opts.cooldown.wait()
+
+    try:
+        rusmarc_page = await context.new_page()
+        try:
+            await rusmarc_page.goto(rusmarc_url)
+            rusmarc_link = rusmarc_page.locator('text=RUSMARC ISO2709')
+            await rusmarc_link.first.wait_for(state='visible', timeout=15000)
+            async with rusmarc_page.expect_download() as download_info:
+                await rusmarc_link.first.click()
+            download = await download_info.value
+            await save_download(download, download.suggested_filename, sync=True)
+            await opts.dir_sync.completed()
+            logging.info(f"Successfully downloaded RUSMARC file for item {index}")
+            return True
+        finally:
+            await rusmarc_page.close()
+    except Exception as e:
+        logging.error(f"Error downloading RUSMARC for item {index}: {str(e)}")
+        return False
+
+async def _fetch_rusmarc_http(session, rusmarc_url, cooldown) -> bool:
+    """Stream the RUSMARC export to disk; False if it couldn't be resolved"""
+    async with session.get(rusmarc_url) as response:
+        cooldown.on_response(response)
+        match = RUSMARC_LINK_RE.search(await response.text())
+        page_url = str(response.url)
+    if not match:
+        return False
+
+    async with session.get(urljoin(page_url, html.unescape(match.group(1)))) as export:
+        cooldown.on_response(export)
+        filename = attachment_filename(export.headers.get('Content-Disposition'))
+        if not export.ok or not filename:
+            return False
+
+        # Disk writes run on aiofiles' thread while the next chunk arrives
+        tmp_path = temp_path_for(filename)
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in export.content.iter_chunked(1 << 18):
+                    await f.write(chunk)
+                # Records are small, so their data is synced before the rename
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+            await aiofiles.os.replace(tmp_path, filename)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            raise
+    return True
+
+async def _download_main_file(new_page, index) -> str:
+    """Download the item's main file and return its name"""
+    download_button = new_page.locator('a#btn-download[onclick="registerDownload()"]')
+    await download_button.click()
+
+    await new_page.wait_for_selector('text="Файл №1"', timeout=60000)
+    popup_download = await new_page.wait_for_selector('.btn-download-part.button:has-text("Скачать")')
+
+    async with new_page.expect_download() as download_info:
+        await popup_download.click()
+
+    download = await download_info.value
+    filename = download.suggested_filename
+    await save_download(download, filename)
+    logging.info(f"Successfully downloaded main file for item {index}")
+    return filename
@@ -1,61 +1,47 @@
 from playwright.async_api import async_playwright
+from aiolimiter import AsyncLimiter
 import asyncio
+import logging
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-import json
-import os
 
-async def process_page(page, url, records):
+from primo import (
+    STORAGE_STATE_PATH, FetchOpts, RecordLedger,
+    fetch_one, import_legacy_records, list_item_buttons, load_records, new_context, record_keys,
+)
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# Append-only binary ledger of downloaded items
+RECORDS_PATH = 'download_records.msgpack'
+
+# Result ids each offset listed, kept apart from the download records so
+# that finished pages are skipped; the latest listing per offset wins
+OFFSETS_PATH = 'offset_listings.msgpack'
+
+# Ledgers written by earlier versions, imported on the first run
+LEGACY_RECORDS_PATHS = ('download_records.json', 'download_records.jsonl')
+
+async def process_button(page, button, i, record_id, opts, popup_lock, sem, limiter):
+    async with sem, limiter:
+        # Clicks on the shared search page are serialized so that each
+        # task receives the popup it opened
+        await fetch_one(page, button, i + 1, record_id, opts, popup_lock)
+
+async def process_page(page, url, opts, sem, limiter):
     await page.goto(url)
-    await page.wait_for_timeout(2000)
     
-    buttons = await page.locator('button.neutralized-button:has-text("Электронная копия")').all()
-    print(f"Found {len(buttons)} buttons on this page")
+    buttons, record_ids = await list_item_buttons(page)
+    count = len(record_ids)
+    logging.info(f"Found {count} buttons on this page")
     
-    for i, button in enumerate(buttons):
-        try:
-            print(f"Processing button {i+1} of {len(buttons)}")
-            async with page.expect_popup() as popup_info:
-                await button.click()
-            new_page = await popup_info.value
-            
-            await new_page.click('text="Карточка"')
-            await new_page.wait_for_timeout(2000)
-            bibl_link = new_page.locator('text=Полное библиографическое описание')
-            rusmarc_url = await bibl_link.get_attribute('href')
-                       
-            # Download main file
-            download_button = new_page.locator('a#btn-download[onclick="registerDownload()"]')
-            await download_button.click()
-            
-            await new_page.wait_for_selector('text="Файл №1"', timeout=60000)
-            popup_download = await new_page.wait_for_selector('.btn-download-part.button:has-text("Скачать")')
-            
-            async with new_page.expect_download() as download_info:
-                await popup_download.click()
-            
-            download = await download_info.value
-            filename = download.suggested_filename
-            await download.save_as(filename)
-            
-            # Save record to dictionary
-            records.append({
-                "rusmarc_url": rusmarc_url,
-                "downloaded_file": filename,
-            })
-            
-            # Save JSON after each successful download
-            with open('download_records.json', 'w', encoding='utf-8') as f:
-                json.dump(records, f, ensure_ascii=False, indent=2)
-            
-            await new_page.wait_for_selector('text="Закрыть"')
-            await new_page.click('text="Закрыть"')
-            
-            await new_page.close()
-            await page.wait_for_timeout(1000)
-            
-        except Exception as e:
-            print(f"Error processing button {i+1}: {str(e)}")
-            continue
+    # Items are handled concurrently, bounded by the shared semaphore and
+    # started no faster than the shared rate limit allows
+    popup_lock = asyncio.Lock()
+    await asyncio.gather(*(
+        process_button(page, buttons.nth(i), i, record_ids[i], opts, popup_lock, sem, limiter)
+        for i in range(count)
+    ))
+    return record_ids
 
 async def main():
     base_url = 'https://primo.nlr.ru/primo-explore/search?query=lsr31,contains,%D0%A0%D1%83%D1%81%D1%81%D0%BA%D0%B0%D1%8F%20%D0%BA%D0%BD%D0%B8%D0%B3%D0%B0%20%D0%B3%D1%80%D0%B0%D0%B6%D0%B4%D0%B0%D0%BD%D1%81%D0%BA%D0%BE%D0%B9%20%D0%BF%D0%B5%D1%87%D0%B0%D1%82%D0%B8%20XVIII%20%D0%B2.,AND&tab=default_tab&search_scope=A1XVIII_07NLR&vid=07NLR_VU2&mfacet=tlevel,include,online_resources,1&mode=advanced'
@@ -65,37 +51,69 @@ async def main():
     end_offset = 60
     step = 10  # Number of items per page
     
-    # Load existing records if file exists
-    records = []
-    if os.path.exists('download_records.json'):
-        with open('download_records.json', 'r', encoding='utf-8') as f:
-            records = json.load(f)
+    # Construct the URL for every offset up front, parsing the base URL once
+    parsed_url = urlparse(base_url)
+    params = parse_qs(parsed_url.query)
+    offset_urls = {
+        offset: urlunparse(parsed_url._replace(query=urlencode({**params, 'offset': [str(offset)]}, doseq=True)))
+        for offset in range(start_offset, end_offset + 1, step)
+    }
     
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=False)
-        page = await browser.new_page()
+    # Load keys of already downloaded items if the ledger exists
+    import_legacy_records(RECORDS_PATH, LEGACY_RECORDS_PATHS)
+    seen = set()
+    for record in load_records(RECORDS_PATH):
+        seen.update(record_keys(record))
+    opts = FetchOpts(ledger=RecordLedger(RECORDS_PATH), seen=seen)
+    
+    # Load the result ids listed on each offset by earlier runs
+    expected = {listing["offset"]: listing["record_ids"] for listing in load_records(OFFSETS_PATH)}
+    offsets_ledger = RecordLedger(OFFSETS_PATH)
+    
+    try:
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(headless=False)
+            context = await new_context(browser, opts)
         
-        # Process pages within the offset range
-        for offset in range(start_offset, end_offset + 1, step):
-            try:
-                # Construct URL with current offset
-                parsed_url = urlparse(base_url)
-                params = parse_qs(parsed_url.query)
-                params['offset'] = [str(offset)]
-                new_query = urlencode(params, doseq=True)
-                parts = list(parsed_url)
-                parts[4] = new_query
-                current_url = urlunparse(parts)
-                
-                print(f"Processing offset {offset}")
-                await process_page(page, current_url, records)
-                print(f"Completed processing offset {offset}")
+            # At most 5 items download at once across all offsets, new items
+            # start at no more than 5 per second, and at most 2 result pages
+            # are open at once to stay clear of rate limits
+            item_sem = asyncio.Semaphore(5)
+            item_limiter = AsyncLimiter(max_rate=5, time_period=1)
+            offset_sem = asyncio.Semaphore(2)
+        
+            async def process_offset(offset, current_url):
+                # Pages whose items were all downloaded before aren't loaded
+                record_ids = expected.get(offset)
+                if record_ids and all(record_id in seen for record_id in record_ids):
+                    logging.info(f"Skipping offset {offset}: all items already downloaded")
+                    return
                 
-            except Exception as e:
-                print(f"Error processing offset {offset}: {str(e)}")
-                continue
+                async with offset_sem:
+                    page = await context.new_page()
+                    try:
+                        logging.info(f"Processing offset {offset}")
+                        record_ids = await process_page(page, current_url, opts, item_sem, item_limiter)
+                        if record_ids != expected.get(offset):
+                            await offsets_ledger.append({"offset": offset, "record_ids": record_ids})
+                        await context.storage_state(path=STORAGE_STATE_PATH)
+                        logging.info(f"Completed processing offset {offset}")
+                    
+                    except Exception as e:
+                        logging.error(f"Error processing offset {offset}: {str(e)}")
+                    finally:
+                        await page.close()
+        
+            # Process pages within the offset range
+            await asyncio.gather(*(
+                process_offset(offset, current_url) for offset, current_url in offset_urls.items()
+            ))
         
-        await browser.close()
+            await browser.close()
+    finally:
+        opts.ledger.close()
+        offsets_ledger.close()
+        opts.dir_sync.sync()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -1,96 +1,40 @@
-from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import async_playwright
 import asyncio
 import logging
+import logging.handlers
+import queue
 from datetime import datetime
 
-# Set up logging
-logging.basicConfig(
-    filename=f'scraper_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+from primo import STORAGE_STATE_PATH, FetchOpts, fetch_one, list_item_buttons, new_context, open_http_session
 
-async def process_single_item(page, button, index):
-    try:
-        logging.info(f"Processing item {index}")
-        
-        # Wait for the new tab with timeout
-        async with page.expect_popup() as popup_info:
-            await button.click()
-        new_page = await popup_info.value
-        
-        try:
-            # Click on "Карточка" tab
-            await new_page.click('text="Карточка"')
-            await new_page.wait_for_timeout(2000)
-            
-            # Get bibliographic description
-            bibl_link = new_page.locator('text=Полное библиографическое описание')
-            
-            async with new_page.expect_popup() as rusmarc_popup_info:
-                await bibl_link.click()
-            rusmarc_page = await rusmarc_popup_info.value
-            await rusmarc_page.wait_for_load_state('networkidle')
-            
-            # Download RUSMARC
-            try:
-                rusmarc_link = rusmarc_page.locator('text=RUSMARC ISO2709')
-                if await rusmarc_link.count() > 0:
-                    async with rusmarc_page.expect_download() as download_info:
-                        await rusmarc_link.click()
-                    download = await download_info.value
-                    await download.save_as(f"{download.suggested_filename}")
-                    logging.info(f"Successfully downloaded RUSMARC file for item {index}")
-            except Exception as e:
-                logging.error(f"Error downloading RUSMARC for item {index}: {str(e)}")
-            
-            await rusmarc_page.close()
-            
-            # Main file download process
-            try:
-                download_button = new_page.locator('a#btn-download[onclick="registerDownload()"]')
-                await download_button.click()
-                
-                await new_page.wait_for_selector('text="Файл №1"', timeout=60000)
-                popup_download = await new_page.wait_for_selector('.btn-download-part.button:has-text("Скачать")')
-                
-                async with new_page.expect_download() as download_info:
-                    await popup_download.click()
-                
-                download = await download_info.value
-                await download.save_as(f"{download.suggested_filename}")
-                logging.info(f"Successfully downloaded main file for item {index}")
-                
-                await new_page.wait_for_selector('text="Закрыть"')
-                await new_page.click('text="Закрыть"')
-            except Exception as e:
-                logging.error(f"Error downloading main file for item {index}: {str(e)}")
-            
-        finally:
-            await new_page.close()
-            
-    except PlaywrightTimeoutError:
-        logging.error(f"Timeout error processing item {index}")
-    except Exception as e:
-        logging.error(f"Unexpected error processing item {index}: {str(e)}")
+# Set up logging; records are queued by the event loop and written to the
+# file by a background listener thread
+log_queue = queue.Queue(-1)
+log_file_handler = logging.FileHandler(f'scraper_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.handlers.QueueHandler(log_queue)])
 
 async def main():
     retry_count = 3
     retry_delay = 5  # seconds
     
-    for attempt in range(retry_count):
+    async with async_playwright() as p:
+        logging.info("Starting browser launch...")
+        browser = await p.chromium.launch(headless=False)
+        logging.info("Browser launched successfully")
+        
         try:
-            async with async_playwright() as p:
-                logging.info("Starting browser launch...")
-                browser = await p.chromium.launch(headless=False)
-                logging.info("Browser launched successfully")
-                
-                logging.info("Creating browser context...")
-                context = await browser.new_context(
-                    user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-                )
-                logging.info("Browser context created")
-                
+            # One context is reused for every attempt; new items pause for a
+            # while whenever the server answers 429
+            logging.info("Creating browser context...")
+            opts = FetchOpts(fetch_rusmarc=True)
+            context = await new_context(browser, opts)
+            logging.info("Browser context created")
+            
+            # Only loading the result list is retried as a whole; items retry
+            # individually, and only the page is recreated on retry
+            for attempt in range(retry_count):
                 logging.info("Creating new page...")
                 page = await context.new_page()
                 logging.info("New page created")
@@ -101,37 +45,45 @@ async def main():
                     await page.goto(link, timeout=60000)
 
                     logging.info("Successfully navigated to URL")
+                    await context.storage_state(path=STORAGE_STATE_PATH)
                     
-                    await page.wait_for_timeout(1000)
-                    
-                    buttons = await page.locator('button.neutralized-button:has-text("Электронная копия")').all()
-                    logging.info(f"Found {len(buttons)} items to process")
-                    
-                    for index, button in enumerate(buttons, 1):
-                        await process_single_item(page, button, index)
-                        await page.wait_for_timeout(1000)  # Delay between items
-                        
-                    logging.info("Successfully completed processing all items")
-                    return  # Success - exit the retry loop
+                    buttons, record_ids = await list_item_buttons(page)
+                    count = len(record_ids)
+                    logging.info(f"Found {count} items to process")
+                    break
                     
                 except Exception as e:
-                    logging.error(f"Error during page processing: {str(e)}")
-                    raise
-                
-                finally:
-                    await browser.close()
+                    await page.close()
+                    logging.error(f"Attempt {attempt + 1} failed: {str(e)}")
+                    if attempt < retry_count - 1:
+                        logging.info(f"Waiting {retry_delay} seconds before retrying...")
+                        await asyncio.sleep(retry_delay)
+                    else:
+                        logging.error("All retry attempts failed")
+                        raise
+            
+            # Resolved URLs are fetched without the browser, reusing the
+            # cookies of the session established above
+            opts.session = await open_http_session(context)
+            try:
+                for index in range(1, count + 1):
+                    await fetch_one(page, buttons.nth(index - 1), index, record_ids[index - 1], opts)
                     
-        except Exception as e:
-            logging.error(f"Attempt {attempt + 1} failed: {str(e)}")
-            if attempt < retry_count - 1:
-                logging.info(f"Waiting {retry_delay} seconds before retrying...")
-                await asyncio.sleep(retry_delay)
-            else:
-                logging.error("All retry attempts failed")
-                raise
+                logging.info("Successfully completed processing all items")
+            finally:
+                await opts.session.close()
+                opts.dir_sync.sync()
+                await page.close()
+        
+        finally:
+            await browser.close()
 
 if __name__ == '__main__':
+    log_listener.start()
     try:
         asyncio.run(main())
     except Exception as e:
-        logging.error(f"Script terminated with error: {str(e)}")
\ No newline at end of file
+        logging.error(f"Script terminated with error: {str(e)}")
+    finally:
+        # Drain queued records to the file before exiting
+        log_listener.stop()
\ No newline at end of file